@@ -0,0 +1,568 @@
+"""
+A long-lived local scoring service for poker hands.
+
+The server keeps poker_hand imported, the Card lookup dicts warmed and a
+score table per fitness type, so that several evaluation processes can
+share one hot evaluator instead of each paying the start-up cost.
+
+Wire format (all integers are big endian):
+    Request:
+        header: request id (uint32), length of fitness type (uint16),
+                number of hands (uint32)
+        body:   fitness type (ascii), then 5 bytes per hand,
+                each byte a card position from 0 to 51
+    Response:
+        header: request id (uint32), status (uint8), length (uint32)
+        body:   status OK    -> length scores (int32 each)
+                status ERROR -> an ascii error message of length bytes
+
+A request may hold at most MAX_HANDS_PER_REQUEST hands; the server answers
+a larger one with an error and closes the connection.
+"""
+import os
+import sys
+import signal
+import stat
+import errno
+import types
+import inspect
+import socket
+import array
+import struct
+import itertools
+import threading
+import time
+import random
+import optparse
+import SocketServer
+
+import poker_hand as ph
+
+REQUEST_HEADER = struct.Struct('!IHI')
+RESPONSE_HEADER = struct.Struct('!IBI')
+HAND_SIZE = 5
+NO_OF_CARD = 52
+MAX_HANDS_PER_REQUEST = 1 << 20
+STATUS_OK = 0
+STATUS_ERROR = 1
+MIN_SCORE = -( 1 << 31 )
+MAX_SCORE = ( 1 << 31 ) - 1
+
+'''
+Fitness types registered in addition to the methods of Poker_Hand,
+mapping from name to a function taking a Poker_Hand and returning an integer
+'''
+fitness_types = {}
+
+def register_fitness_type ( name, function ):
+    """
+    Register a fitness type so that the server could score it
+    Parameters:
+        name: string
+        function: a function with a Poker_Hand as input and an integer as output
+    """
+    fitness_types[name] = function
+
+def load_fitness_type ( spec ):
+    """
+    Import a fitness function and register it under its own name
+    Parameters:
+        spec: string ('module:function')
+    """
+    module_name, function_name = spec.split( ':', 1 )
+    module = __import__( module_name, fromlist = [function_name] )
+    register_fitness_type( function_name, getattr( module, function_name ) )
+
+def get_fitness_function ( fitness_type ):
+    """
+    Get the function computing a fitness type, or None if it is unknown.
+    As in Poker_Hand.fitness_value, a fitness type could be the name
+    of a Poker_Hand method taking no argument
+    Parameters:
+        fitness_type: string
+    """
+    if fitness_type in fitness_types:
+        return fitness_types[fitness_type]
+    if fitness_type.startswith( '_' ):
+        return None
+    method = getattr( ph.Poker_Hand, fitness_type, None )
+    '''Class methods such as mutate or random_poker_hand are bound to the class'''
+    if not isinstance( method, types.MethodType ) or method.im_self is not None:
+        return None
+    args, varargs, keywords, defaults = inspect.getargspec( method )
+    if len(args) != 1 or varargs or keywords:
+        return None
+    return lambda hand: getattr( hand, fitness_type )()
+
+def parse_address ( address ):
+    """
+    Parse an address given as 'host:port' (localhost TCP)
+    or as a file path (Unix socket)
+    Parameters:
+        address: string
+    """
+    if ':' in address:
+        host, port = address.rsplit( ':', 1 )
+        return ( socket.AF_INET, ( host, int(port) ) )
+    return ( socket.AF_UNIX, address )
+
+class Connection_Closed( Exception ):
+    """
+    The other side closed the connection in the middle of a message
+    """
+    pass
+
+def recv_exactly ( sock, size ):
+    """
+    Read exactly size bytes from a socket, or return None if
+    the connection is closed before any byte is read
+    """
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = sock.recv( remaining )
+        if not chunk:
+            if remaining == size:
+                return None
+            raise Connection_Closed('Connection closed in the middle of a message')
+        chunks.append( chunk )
+        remaining -= len(chunk)
+    return ''.join( chunks )
+
+def encode_request ( request_id, fitness_type, hands ):
+    """
+    Encode a batch of hands into a request message
+    Parameters:
+        request_id: integer
+        fitness_type: string
+        hands: list of tuples of 5 card positions
+    """
+    if len(hands) > MAX_HANDS_PER_REQUEST:
+        raise Exception('A request could have at most ' + str(MAX_HANDS_PER_REQUEST) + ' hands')
+    if set( map( len, hands ) ) - set( [HAND_SIZE] ):
+        raise Exception('Poker hands is not valid: A poker hand must have 5 cards!')
+    body = bytearray( itertools.chain.from_iterable( hands ) )
+    return ( REQUEST_HEADER.pack( request_id, len(fitness_type), len(hands) )
+             + fitness_type + str( body ) )
+
+'''
+binomial[n][k] is the number of ways to choose k cards out of n
+'''
+binomial = [[1] + [0] * HAND_SIZE for n in xrange( NO_OF_CARD + 1 )]
+for n in xrange( 1, NO_OF_CARD + 1 ):
+    for k in xrange( 1, HAND_SIZE + 1 ):
+        binomial[n][k] = binomial[n - 1][k - 1] + binomial[n - 1][k]
+NO_OF_HAND = binomial[NO_OF_CARD][HAND_SIZE]
+
+def hand_rank ( card_pos ):
+    """
+    Get a number from 0 to NO_OF_HAND - 1 for each hand (the combinatorial
+    number system), so that a hand could index a dense table
+    Parameters:
+        card_pos: sorted list of 5 card positions
+    """
+    if card_pos[-1] >= NO_OF_CARD:
+        raise Exception('Card position ' + str(card_pos[-1]) + ' is not from 0 to ' + str(NO_OF_CARD - 1))
+    rank = 0
+    previous = -1
+    for k in xrange( HAND_SIZE ):
+        pos = card_pos[k]
+        if pos == previous:
+            raise Exception('Poker hands is not valid: Cards of the same value')
+        rank += binomial[pos][k + 1]
+        previous = pos
+    return rank
+
+class Score_Table():
+    """
+    Scores of the hands that have been evaluated, one table per fitness type.
+    Each table is dense, indexed by hand_rank, with a 4 bytes score and
+    a 1 byte flag for each of the 2598960 hands: about 13MB per fitness type
+    that has been requested, however long the server runs.
+    Fitness functions are assumed to give the same score to the same hand.
+    """
+    def __init__ ( self ):
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def get_table ( self, fitness_type ):
+        if fitness_type not in self.tables:
+            with self.lock:
+                if fitness_type not in self.tables:
+                    self.tables[fitness_type] = ( array.array( 'i', [0] ) * NO_OF_HAND,
+                                                  bytearray( NO_OF_HAND ) )
+        return self.tables[fitness_type]
+
+    def score ( self, fitness_type, function, card_pos ):
+        """
+        Get the score of a hand, evaluating it only the first time it is seen
+        Parameters:
+            fitness_type: string
+            function: the function computing the fitness type
+            card_pos: 5 card positions
+        """
+        card_pos = sorted( card_pos )
+        rank = hand_rank( card_pos )
+        table = self.tables.get( fitness_type )
+        if table is not None and table[1][rank]:
+            return table[0][rank]
+        hand = ph.Poker_Hand( [ph.Card.get_card(pos) for pos in card_pos] )
+        value = function( hand )
+        if not isinstance( value, (int, long) ) or not MIN_SCORE <= value <= MAX_SCORE:
+            raise Exception( fitness_type + ' returned ' + repr(value) + ', not a 32 bit integer' )
+        '''The table is only made once the fitness type has given a valid score'''
+        scores, known = self.get_table( fitness_type )
+        scores[rank] = value
+        known[rank] = 1
+        return value
+
+    def precompute ( self, fitness_type, function ):
+        """
+        Score every possible hand, so that no request has to build a Poker_Hand.
+        This takes under a minute for get_simple_score
+        """
+        for card_pos in itertools.combinations( xrange( NO_OF_CARD ), HAND_SIZE ):
+            self.score( fitness_type, function, card_pos )
+
+class Score_Handler( SocketServer.BaseRequestHandler ):
+    """
+    Serve the requests of one connection in the order they arrive,
+    so a client could pipeline several requests before reading the responses
+    """
+    def handle ( self ):
+        try:
+            while self.handle_request():
+                pass
+        except ( Connection_Closed, socket.error ):
+            '''The client went away, there is nobody to answer'''
+            pass
+
+    def handle_request ( self ):
+        """
+        Read one request and answer it.
+        Return False when the connection should be closed
+        """
+        header = recv_exactly( self.request, REQUEST_HEADER.size )
+        if header is None:
+            return False
+        request_id, name_length, no_of_hand = REQUEST_HEADER.unpack( header )
+        if no_of_hand > MAX_HANDS_PER_REQUEST:
+            '''The body is left unread, so the connection could not be used any more'''
+            self.request.sendall( self.error( request_id, 'A request could have at most '
+                                              + str(MAX_HANDS_PER_REQUEST) + ' hands' ) )
+            return False
+        fitness_type = recv_exactly( self.request, name_length ) if name_length else ''
+        data = recv_exactly( self.request, no_of_hand * HAND_SIZE ) if no_of_hand else ''
+        if fitness_type is None or data is None:
+            return False
+        self.request.sendall( self.score_batch( request_id, fitness_type, no_of_hand, data ) )
+        return True
+
+    def score_batch ( self, request_id, fitness_type, no_of_hand, data ):
+        """
+        Score a batch of hands and encode the response message
+        """
+        function = get_fitness_function( fitness_type )
+        if function is None:
+            return self.error( request_id, 'Unknown fitness type: ' + fitness_type )
+        score_table = self.server.score_table
+        scores = []
+        try:
+            cards = bytearray( data )
+            for i in xrange( no_of_hand ):
+                card_pos = cards[i * HAND_SIZE : (i + 1) * HAND_SIZE]
+                scores.append( score_table.score( fitness_type, function, card_pos ) )
+            return ( RESPONSE_HEADER.pack( request_id, STATUS_OK, no_of_hand )
+                     + struct.pack( '!%di' % no_of_hand, *scores ) )
+        except Exception as e:
+            return self.error( request_id, 'Hand ' + str(i) + ': ' + str(e) )
+
+    def error ( self, request_id, message ):
+        return RESPONSE_HEADER.pack( request_id, STATUS_ERROR, len(message) ) + message
+
+class Threading_TCP_Score_Server( SocketServer.ThreadingMixIn, SocketServer.TCPServer ):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Threading_Unix_Score_Server( SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer ):
+    daemon_threads = True
+
+    def server_close ( self ):
+        SocketServer.UnixStreamServer.server_close( self )
+        if os.path.exists( self.server_address ):
+            os.remove( self.server_address )
+
+def remove_stale_socket ( path ):
+    """
+    Remove a Unix socket left behind by a server that is not running any more.
+    Anything else at the path (a regular file, a live server) is left alone
+    Parameters:
+        path: string
+    """
+    if not os.path.exists( path ):
+        return
+    if not stat.S_ISSOCK( os.stat( path ).st_mode ):
+        raise Exception( path + ' exists and is not a socket' )
+    probe = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+        probe.connect( path )
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.remove( path )
+        return
+    finally:
+        probe.close()
+    raise Exception( 'A server is already listening on ' + path )
+
+def make_server ( address, precomputed_types = () ):
+    """
+    Create a scoring server listening on the given address,
+    with the evaluator already warmed up
+    Parameters:
+        address: string ('host:port' or a Unix socket path)
+        precomputed_types: fitness types to score for every hand before listening
+    """
+    score_table = Score_Table()
+    for fitness_type in precomputed_types:
+        function = get_fitness_function( fitness_type )
+        if function is None:
+            raise Exception( 'Unknown fitness type: ' + fitness_type )
+        score_table.precompute( fitness_type, function )
+    family, server_address = parse_address( address )
+    if family == socket.AF_UNIX:
+        remove_stale_socket( server_address )
+        server = Threading_Unix_Score_Server( server_address, Score_Handler )
+    else:
+        server = Threading_TCP_Score_Server( server_address, Score_Handler )
+    server.score_table = score_table
+    '''Build the lazy lookup dicts of Card before the first request comes'''
+    ph.Card('A', 'Club').get_pos()
+    return server
+
+class Score_Client():
+    """
+    A client for the scoring server, keeping a pool of open connections
+    that could be shared between threads
+    """
+    def __init__ ( self, address, pool_size = 4 ):
+        """
+        Constructor:
+        Parameters:
+            address: string ('host:port' or a Unix socket path)
+            pool_size: maximum number of open connections
+        """
+        self.family, self.server_address = parse_address( address )
+        self.idle = []
+        self.pool_size = pool_size
+        self.no_of_connection = 0
+        self.lock = threading.Lock()
+        '''Notified whenever a connection is released or discarded'''
+        self.condition = threading.Condition( self.lock )
+        self.request_id = 0
+
+    def next_request_id ( self ):
+        with self.lock:
+            self.request_id = ( self.request_id + 1 ) % ( 1 << 32 )
+            return self.request_id
+
+    def acquire ( self ):
+        """
+        Get a connection from the pool, opening a new one if the pool
+        is not full yet, otherwise waiting for one to be released or discarded
+        """
+        with self.condition:
+            while not self.idle and self.no_of_connection >= self.pool_size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.no_of_connection += 1
+        try:
+            sock = socket.socket( self.family, socket.SOCK_STREAM )
+            sock.connect( self.server_address )
+            if self.family == socket.AF_INET:
+                sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+            return sock
+        except Exception:
+            with self.condition:
+                self.no_of_connection -= 1
+                self.condition.notify()
+            raise
+
+    def release ( self, sock ):
+        with self.condition:
+            self.idle.append( sock )
+            self.condition.notify()
+
+    def discard ( self, sock ):
+        """
+        Close a connection that is left in an unknown state,
+        so that a waiting thread could open a new one
+        """
+        sock.close()
+        with self.condition:
+            self.no_of_connection -= 1
+            self.condition.notify()
+
+    def score_batch ( self, hands, fitness_type = 'get_simple_score' ):
+        """
+        Score a batch of hands
+        Parameters:
+            hands: list of tuples of 5 card positions
+            fitness_type: string (a Poker_Hand method or a fitness type registered on the server)
+        """
+        return self.score_batches( [hands], fitness_type )[0]
+
+    def score_batches ( self, batches, fitness_type = 'get_simple_score' ):
+        """
+        Score several batches of hands, pipelining them over one connection:
+        the requests are sent while a reader thread collects the responses,
+        so neither side blocks on a full socket buffer however long the pipeline is
+        (a single request is sent and read on the calling thread)
+        Parameters:
+            batches: list of lists of tuples of 5 card positions
+            fitness_type: string (a Poker_Hand method or a fitness type registered on the server)
+        """
+        request_ids = [self.next_request_id() for batch in batches]
+        messages = [encode_request( request_ids[i], fitness_type, batches[i] )
+                    for i in xrange(len(batches))]
+        sock = self.acquire()
+        results = []
+        failures = []
+        if len(messages) == 1:
+            '''
+            The server reads a whole request before answering it,
+            so a single request could be sent and read on this thread
+            '''
+            try:
+                sock.sendall( messages[0] )
+                results.append( self.read_response( sock, request_ids[0] ) )
+            except Exception as e:
+                failures.append( e )
+        else:
+            reader = threading.Thread( target = self.read_responses,
+                                       args = ( sock, request_ids, results, failures ) )
+            reader.daemon = True
+            reader.start()
+            try:
+                for message in messages:
+                    sock.sendall( message )
+            except Exception as e:
+                '''Wake the reader up, the server will not answer any more'''
+                try:
+                    sock.shutdown( socket.SHUT_RDWR )
+                except socket.error:
+                    pass
+                failures.append( e )
+            reader.join()
+        errors = [result for result in results if isinstance( result, Exception )]
+        if failures:
+            self.discard( sock )
+            raise ( errors + failures )[0]
+        self.release( sock )
+        if errors:
+            raise errors[0]
+        return results
+
+    def read_responses ( self, sock, request_ids, results, failures ):
+        """
+        Read the responses of the given requests into results,
+        or put the Exception into failures if the connection breaks
+        """
+        try:
+            for request_id in request_ids:
+                results.append( self.read_response( sock, request_id ) )
+        except Exception as e:
+            failures.append( e )
+
+    def read_response ( self, sock, request_id ):
+        """
+        Read one response, returning the list of scores or,
+        if the server reports an error, the Exception to raise
+        """
+        header = recv_exactly( sock, RESPONSE_HEADER.size )
+        if header is None:
+            raise Exception('Connection closed by the scoring server')
+        response_id, status, length = RESPONSE_HEADER.unpack( header )
+        if response_id != request_id:
+            raise Exception('Response out of order from the scoring server')
+        if status == STATUS_ERROR:
+            return Exception( recv_exactly( sock, length ) if length else '' )
+        data = recv_exactly( sock, length * 4 ) if length else ''
+        return list( struct.unpack( '!%di' % length, data ) )
+
+    def close ( self ):
+        with self.condition:
+            idle = self.idle
+            self.idle = []
+        for sock in idle:
+            self.discard( sock )
+
+def random_hands ( no_of_hand ):
+    return [tuple(random.sample( xrange(52), HAND_SIZE )) for i in xrange( no_of_hand )]
+
+def benchmark ( address, no_of_hand, batch_size, pipeline ):
+    """
+    Compare the throughput of the scoring server against
+    in-process get_simple_score on the same random hands
+    Parameters:
+        address: string ('host:port' or a Unix socket path)
+        no_of_hand: number of hands to score
+        batch_size: number of hands in each request
+        pipeline: number of requests sent before reading the responses
+    """
+    hands = random_hands( no_of_hand )
+
+    start = time.time()
+    local_scores = [ph.Poker_Hand( [ph.Card.get_card(pos) for pos in hand] ).get_simple_score()
+                    for hand in hands]
+    local_time = time.time() - start
+
+    client = Score_Client( address, pool_size = 1 )
+    batches = [hands[i:i + batch_size] for i in xrange( 0, no_of_hand, batch_size )]
+    start = time.time()
+    remote_scores = []
+    for i in xrange( 0, len(batches), pipeline ):
+        for scores in client.score_batches( batches[i:i + pipeline] ):
+            remote_scores.extend( scores )
+    remote_time = time.time() - start
+    client.close()
+
+    if remote_scores != local_scores:
+        raise Exception('Scores from the server differ from in-process scores')
+    print 'In-process get_simple_score : ' + str(int( no_of_hand / local_time )) + ' hands/s'
+    print 'Scoring server              : ' + str(int( no_of_hand / remote_time )) + ' hands/s'
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [OPTIONS]")
+    parser.add_option('-a', '--address', default='127.0.0.1:8113',
+                      help='host:port or Unix socket path')
+    parser.add_option('-f', '--fitness', action='append', default=[],
+                      help='Register a fitness function given as module:function')
+    parser.add_option('-w', '--precompute', action='append', default=[],
+                      help='Score every hand for this fitness type before serving')
+    parser.add_option('-b', '--benchmark', action='store_true', default=False,
+                      help='Benchmark a running server instead of serving')
+    parser.add_option('-n', '--size', default='100000',
+                      help='Number of hands for the benchmark')
+    parser.add_option('-k', '--batch', default='1000',
+                      help='Number of hands per request for the benchmark')
+    parser.add_option('-p', '--pipeline', default='8',
+                      help='Number of pipelined requests for the benchmark')
+
+    options, args = parser.parse_args()
+    if options.benchmark:
+        benchmark( options.address, int(options.size), int(options.batch), int(options.pipeline) )
+    else:
+        for spec in options.fitness:
+            load_fitness_type( spec )
+        server = make_server( options.address, options.precompute )
+        print 'Scoring server listening on ' + options.address
+        '''Stop on SIGTERM as on Ctrl-C, so that the Unix socket is removed'''
+        signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit(0) )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
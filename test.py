@@ -1,5 +1,7 @@
 import poker_hand as ph
+import score_server as ss
 import util
+import threading
 from collections import defaultdict
 import optparse
 
@@ -25,6 +27,74 @@ class Card_Score_Test ():
             print hand
             print hand.fitness_value ( util.plus_one, 'get_simple_score' )
         
+class Score_Server_Test ():
+    """
+    Compare the scores of a local scoring server with in-process scores,
+    and check that bad requests are answered with an error
+    """
+    def __init__ ( self ):
+        self.server = ss.make_server ( '127.0.0.1:0' )
+        self.address = '127.0.0.1:' + str(self.server.server_address[1])
+
+    def run ( self ):
+        thread = threading.Thread( target = self.server.serve_forever )
+        thread.daemon = True
+        thread.start()
+        client = ss.Score_Client( self.address, pool_size = 2 )
+        try:
+            hands = ss.random_hands( 2000 )
+            poker_hands = [ph.Poker_Hand( [ph.Card.get_card(pos) for pos in hand] ) for hand in hands]
+            if client.score_batch( hands ) != [hand.get_simple_score() for hand in poker_hands]:
+                raise Exception('Scores from the server differ from in-process scores')
+            if client.score_batch( hands, 'is_flush' ) != [int(hand.is_flush()) for hand in poker_hands]:
+                raise Exception('Scores of a Poker_Hand method differ from in-process scores')
+            print 'Batch scores match in-process get_simple_score'
+
+            bad_requests = [ ( [(0, 1, 2, 3, 4)], 'unknown_fitness' ),
+                             ( [(0, 1, 2, 3, 52)], 'get_simple_score' ),
+                             ( [(0, 1, 2, 3, 3)], 'get_simple_score' ),
+                             ( [(0, 1, 2, 3, 4)], 'get_same_kinds' ),
+                             ( [(0, 1, 2, 3, 4)], 'random_poker_hand' ) ]
+            for hands, fitness_type in bad_requests:
+                try:
+                    client.score_batch( hands, fitness_type )
+                except Exception as e:
+                    print 'Error as expected: ' + str(e)
+                else:
+                    raise Exception('No error for ' + str(hands) + ' with ' + fitness_type)
+
+            '''A pipeline much larger than the socket buffers must not deadlock'''
+            batches = [[(0, 4, 8, 12, 1)] * 500000] * 8
+            results = []
+            pipeline = threading.Thread( target = lambda: results.extend( client.score_batches( batches ) ) )
+            pipeline.daemon = True
+            pipeline.start()
+            pipeline.join( 60 )
+            if pipeline.is_alive():
+                raise Exception('Pipelined requests did not complete')
+            if results != [[1] * 500000] * 8:
+                raise Exception('Pipelined scores are wrong')
+            print 'Pipeline of ' + str(len(batches)) + ' large batches completed'
+
+            '''A thread waiting for the only connection must get a new one when it is discarded'''
+            single_client = ss.Score_Client( self.address, pool_size = 1 )
+            sock = single_client.acquire()
+            results = []
+            waiting = threading.Thread( target = lambda: results.append( single_client.score_batch( [(0, 1, 2, 3, 4)] ) ) )
+            waiting.daemon = True
+            waiting.start()
+            waiting.join( 0.2 )
+            single_client.discard( sock )
+            waiting.join( 10 )
+            single_client.close()
+            if waiting.is_alive() or results != [[8]]:
+                raise Exception('Waiting thread did not get a new connection')
+            print 'Waiting thread got a new connection after a discard'
+        finally:
+            client.close()
+            self.server.shutdown()
+            self.server.server_close()
+
 class Test():
     def __init__ (self):
         self.population = ph.Population ( 50, wrapper_function = util.plus_one, threshold = 7 )
@@ -48,8 +118,13 @@ if __name__ == "__main__":
                       help='Suit mutation rate')
     parser.add_option('-e', '--elitism', default='0.1',
                       help='Elitism rate')
+    parser.add_option('-t', '--servertest', action='store_true', default=False,
+                      help='Test the scoring server instead of running the algorithm')
     
     options, args = parser.parse_args()
+    if options.servertest:
+        Score_Server_Test().run()
+        raise SystemExit
     params = {}
     
     try: